@@ -1,14 +1,36 @@
 import os
-import io
 import re
 import zipfile
+import tempfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Iterator, List, Mapping, Optional, Set, Tuple
 
 import requests
 
 
+# Captures are bounded and stop at end of line so a stray quote in a huge
+# log can't make the engine scan far ahead from every match position.
+# ModuleNotFoundError: No module named 'requests'
+_DEP_PAT = r"No module named ['\"](?P<dep>[^'\"\n]{1,512})['\"]"
+# FileNotFoundError: [Errno 2] No such file or directory: 'config/settings.json'
+_PATH_PAT = r"No such file or directory: ['\"](?P<path>[^'\"\n]{1,512})['\"]"
+_DIAG_RE = re.compile(f"{_DEP_PAT}|{_PATH_PAT}")
+_DEP_RE = re.compile(_DEP_PAT)
+
+# Step logs ("<job>/<n>_<step>.txt") that never hold test failures; read only as a fallback.
+# The archive may drop the "/" from "actions/checkout", hence the optional slash.
+_SKIP_STEP_LOG_RE = re.compile(r"^\d+_(?:Set up job|Complete job|Post |Run actions/?checkout@)")
+
+# Passed per-invocation instead of running `git config` first
+GIT_IDENTITY = [
+    "-c", "user.name=ci-janitor-bot",
+    "-c", "user.email=ci-janitor@users.noreply.github.com",
+]
+
+
 # =========================
 # Helpers
 # =========================
@@ -17,9 +39,6 @@ def run_git(cmd):
 
 
 def commit_and_push_fix(commit_msg: str, branch: str):
-    run_git(["git", "config", "user.name", "ci-janitor-bot"])
-    run_git(["git", "config", "user.email", "ci-janitor@users.noreply.github.com"])
-
     status = subprocess.run(
         ["git", "status", "--porcelain"],
         capture_output=True,
@@ -31,36 +50,42 @@ def commit_and_push_fix(commit_msg: str, branch: str):
         return
 
     run_git(["git", "add", "-A"])
-    run_git(["git", "commit", "-m", commit_msg])
+    run_git(["git", *GIT_IDENTITY, "commit", "-m", commit_msg])
     run_git(["git", "push", "origin", f"HEAD:{branch}"])
 
 
-def find_missing_dependency(logs: str) -> Optional[str]:
-    # ModuleNotFoundError: No module named 'requests'
-    m = re.search(r"No module named ['\"]([^'\"]+)['\"]", logs)
+def diagnose(logs: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Return (missing_dependency, missing_file_path) from the logs.
+    A missing dependency takes priority, so a file hit only rescans what follows it.
+    """
+    if "No module named" not in logs and "No such file or directory" not in logs:
+        return None, None
+    m = _DIAG_RE.search(logs)
     if not m:
-        return None
-    return m.group(1).strip()
-
-
-def find_missing_file_path(logs: str) -> Optional[str]:
-    # FileNotFoundError: [Errno 2] No such file or directory: 'config/settings.json'
-    m = re.search(r"No such file or directory: ['\"]([^'\"]+)['\"]", logs)
-    if not m:
-        return None
-    return m.group(1).strip()
+        return None, None
+    dep, path = m.group("dep"), m.group("path")
+    if path:
+        later = _DEP_RE.search(logs, m.end())
+        if later:
+            dep = later.group("dep")
+    return (dep.strip() if dep else None), (path.strip() if path else None)
 
 
 def make_log_excerpt(logs: str, max_lines: int = 30, max_chars: int = 1800) -> str:
     lines = logs.splitlines()
 
-    # Prefer showing around the first helpful error
-    keywords = ["ModuleNotFoundError", "FileNotFoundError", "No such file or directory"]
+    # Prefer showing around the first ModuleNotFoundError, else the first file error
     idx = None
-    for k in keywords:
-        idx = next((i for i, l in enumerate(lines) if k in l), None)
-        if idx is not None:
+    file_idx = None
+    for i, l in enumerate(lines):
+        if "ModuleNotFoundError" in l:
+            idx = i
             break
+        if file_idx is None and ("FileNotFoundError" in l or "No such file or directory" in l):
+            file_idx = i
+    if idx is None:
+        idx = file_idx
 
     if idx is None:
         snippet = lines[:max_lines]
@@ -75,10 +100,12 @@ def make_log_excerpt(logs: str, max_lines: int = 30, max_chars: int = 1800) -> s
     return text
 
 
-def get_branch_name() -> str:
-    branch = os.environ.get("PR_BRANCH")
+def get_branch_name(env: Optional[Mapping[str, str]] = None) -> str:
+    if env is None:
+        env = os.environ
+    branch = env.get("PR_BRANCH")
     if not branch:
-        branch = os.environ.get("GITHUB_REF_NAME") or os.environ.get("GITHUB_HEAD_REF")
+        branch = env.get("GITHUB_REF_NAME") or env.get("GITHUB_HEAD_REF")
     if not branch:
         raise RuntimeError("PR_BRANCH not set and could not infer branch name for push.")
     return branch
@@ -97,71 +124,111 @@ class GitHubTool:
             "Authorization": f"Bearer {self.token}",
             "Accept": "application/vnd.github+json",
         }
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
 
     def _get_json(self, url: str) -> dict:
-        r = requests.get(url, headers=self.headers)
+        r = self.session.get(url)
         r.raise_for_status()
         return r.json()
 
     def _post_json(self, url: str, payload: dict):
-        r = requests.post(url, headers=self.headers, json=payload)
+        r = self.session.post(url, json=payload)
         r.raise_for_status()
         return r.json()
 
-    def get_ci_logs(self) -> str:
+    def _resolve_run_id(self) -> str:
         """
-        Fetch logs for a workflow run.
+        Find the workflow run to read logs from.
         - If RUN_ID is set: use it.
         - Else if PR_NUMBER is set: find latest failed "CI" run for that PR head SHA.
         """
-        run_id = self.run_id
-
-        if not run_id:
-            if not self.pr_number:
-                raise RuntimeError("Neither RUN_ID nor PR_NUMBER set; cannot fetch CI logs.")
-
-            # Get PR details -> head SHA
-            pr_url = f"https://api.github.com/repos/{self.repo}/pulls/{self.pr_number}"
-            pr = self._get_json(pr_url)
-            head_sha = pr["head"]["sha"]
-
-            # Find workflow runs for that SHA; pick the latest failed CI run
-            runs_url = f"https://api.github.com/repos/{self.repo}/actions/runs?per_page=50"
-            runs = self._get_json(runs_url).get("workflow_runs", [])
-
-            chosen = None
-            for r in runs:
-                if r.get("head_sha") != head_sha:
-                    continue
-                name = (r.get("name") or "").lower()
-                if "ci" not in name:
-                    continue
-                if r.get("conclusion") == "failure":
-                    chosen = r
-                    break
-
-            if not chosen:
-                for r in runs:
-                    if r.get("head_sha") == head_sha and r.get("conclusion") == "failure":
-                        chosen = r
-                        break
-
-            if not chosen:
-                raise RuntimeError("Could not find a failed CI run for this PR to fetch logs from.")
-
-            run_id = str(chosen["id"])
-            self.run_id = run_id  # cache it for commenting
-
+        if self.run_id:
+            return self.run_id
+
+        if not self.pr_number:
+            raise RuntimeError("Neither RUN_ID nor PR_NUMBER set; cannot fetch CI logs.")
+
+        # PR details (-> head SHA) and recent workflow runs don't depend on each other
+        pr_url = f"https://api.github.com/repos/{self.repo}/pulls/{self.pr_number}"
+        runs_url = f"https://api.github.com/repos/{self.repo}/actions/runs?per_page=50"
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            # requests doesn't document Session as thread-safe, so the worker makes a one-off request
+            runs_fut = ex.submit(requests.get, runs_url, headers=self.headers)
+            head_sha = self._get_json(pr_url)["head"]["sha"]
+            runs_resp = runs_fut.result()
+        runs_resp.raise_for_status()
+        runs = runs_resp.json().get("workflow_runs", [])
+
+        # Pick the latest failed CI run for that SHA
+        by_sha: Dict[str, List[dict]] = {}
+        for r in runs:
+            by_sha.setdefault(r.get("head_sha"), []).append(r)
+
+        # Prefer a failed run whose workflow name mentions "ci"
+        failed = [r for r in by_sha.get(head_sha, []) if r.get("conclusion") == "failure"]
+        chosen = next((r for r in failed if "ci" in (r.get("name") or "").lower()), None)
+        if not chosen and failed:
+            chosen = failed[0]
+
+        if not chosen:
+            raise RuntimeError("Could not find a failed CI run for this PR to fetch logs from.")
+
+        run_id = str(chosen["id"])
+        self.run_id = run_id  # cache it for commenting
+        return run_id
+
+    def iter_log_chunks(self) -> Iterator[Tuple[int, str]]:
+        """
+        Yield (archive position, decoded step log) for the failed run, one member at a time.
+        Setup/checkout/post steps come last since they rarely hold the failure.
+        """
+        run_id = self._resolve_run_id()
         url = f"https://api.github.com/repos/{self.repo}/actions/runs/{run_id}/logs"
-        response = requests.get(url, headers=self.headers)
+        response = self.session.get(url, stream=True)
         response.raise_for_status()
 
-        zip_file = zipfile.ZipFile(io.BytesIO(response.content))
-        logs = ""
-        for name in zip_file.namelist():
-            logs += zip_file.read(name).decode("utf-8", errors="ignore")
+        # zipfile needs a seekable file; spool to disk past 8 MiB
+        with tempfile.SpooledTemporaryFile(max_size=8 << 20) as buf:
+            for chunk in response.iter_content(1 << 16):
+                buf.write(chunk)
+            buf.seek(0)
+
+            with zipfile.ZipFile(buf) as zip_file:
+                relevant, skipped = [], []
+                for pos, name in enumerate(zip_file.namelist()):
+                    if _SKIP_STEP_LOG_RE.match(name.split("/", 1)[-1]):
+                        skipped.append((pos, name))
+                    else:
+                        relevant.append((pos, name))
 
-        return logs
+                for pos, name in relevant + skipped:
+                    yield pos, zip_file.read(name).decode("utf-8", errors="ignore")
+
+    def get_ci_logs(self) -> str:
+        """
+        Fetch logs for the failed workflow run.
+        Returns the first step log with a missing dependency; failing that, the first
+        with a missing file; else all step logs joined in archive order.
+        """
+        parts = []
+        path_hit = None
+        # closing() releases the spooled file and zip as soon as we return early
+        with closing(self.iter_log_chunks()) as chunks:
+            for pos, text in chunks:
+                dep, missing_path = diagnose(text)
+                if dep:
+                    return text
+                if path_hit is not None:
+                    continue  # only a later dependency hit can beat it; no fallback needed
+                if missing_path:
+                    path_hit = text
+                else:
+                    parts.append((pos, text))
+        if path_hit is not None:
+            return path_hit
+        parts.sort()
+        return "".join(text for _, text in parts)
 
     def get_pr_number(self) -> int:
         """
@@ -193,19 +260,35 @@ class GitHubTool:
 # Filesystem Tool
 # =========================
 class FilesystemTool:
+    def __init__(self):
+        # Stripped requirements.txt entries, read once on first add_dependency.
+        # Keyed to the cwd-relative path, so this assumes cwd doesn't change.
+        self._existing: Optional[Set[str]] = None
+        self._needs_newline = False
+
+    def _load_existing(self, req: Path) -> Set[str]:
+        line = ""
+        entries = set()
+        with req.open(encoding="utf-8") as f:
+            for line in f:
+                entries.add(line.strip())
+        entries.discard("")
+        self._needs_newline = bool(line) and not line.endswith("\n")
+        return entries
+
     def add_dependency(self, dependency: str):
         req = Path("requirements.txt")
-        content = req.read_text()
-
         dep = dependency.strip()
-        lines = [l.strip() for l in content.splitlines() if l.strip()]
 
-        if dep in lines:
+        if self._existing is None:
+            self._existing = self._load_existing(req)
+        if dep in self._existing:
             return
 
-        if not content.endswith("\n"):
-            content += "\n"
-        req.write_text(content + dep + "\n")
+        with req.open("a", encoding="utf-8") as f:
+            f.write(("\n" if self._needs_newline else "") + dep + "\n")
+        self._needs_newline = False
+        self._existing.add(dep)
 
     def create_placeholder_file(self, rel_path: str):
         p = Path(rel_path)
@@ -225,11 +308,11 @@ class CIFixAgent:
     def run(self):
         logs = self.github.get_ci_logs()
 
-        dep = find_missing_dependency(logs)
-        missing_path = find_missing_file_path(logs)
+        dep, missing_path = diagnose(logs)
 
-        approved = os.environ.get("CI_JANITOR_APPROVED", "0") == "1"
-        approved_create_file = os.environ.get("CI_JANITOR_APPROVED_CREATE_FILE", "0") == "1"
+        env = dict(os.environ)  # snapshot once for this run
+        approved = env.get("CI_JANITOR_APPROVED", "0") == "1"
+        approved_create_file = env.get("CI_JANITOR_APPROVED_CREATE_FILE", "0") == "1"
         excerpt = make_log_excerpt(logs)
 
         # ---- Case 1: Missing dependency ----
@@ -249,7 +332,7 @@ class CIFixAgent:
 
             # Approved: apply fix
             self.fs.add_dependency(dep)
-            branch = get_branch_name()
+            branch = get_branch_name(env)
             commit_and_push_fix(f"ci-fix: add missing dependency {dep}", branch)
             self.github.post_pr_comment(f"🤖 CI Janitor: added `{dep}` to `requirements.txt` and pushed a fix.")
             print(f"✔ Fixed and committed missing dependency: {dep}")
@@ -272,7 +355,7 @@ class CIFixAgent:
 
             # Approved: create placeholder file
             self.fs.create_placeholder_file(missing_path)
-            branch = get_branch_name()
+            branch = get_branch_name(env)
             commit_and_push_fix(f"ci-fix: create placeholder file {missing_path}", branch)
             self.github.post_pr_comment(f"🤖 CI Janitor: created placeholder `{missing_path}` and pushed a fix.")
             print(f"✔ Created placeholder file: {missing_path}")